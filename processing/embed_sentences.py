@@ -4,76 +4,882 @@ Flask API for generating embeddings and FAISS-based semantic search
 """
 
 import os
+
+# Gunicorn worker processes sharing the index files (see Dockerfile)
+EMBEDDING_WORKERS = int(os.environ.get("EMBEDDING_WORKERS", 1))
+# Cores per worker process; OpenMP/BLAS pools are sized to this so the
+# workers do not oversubscribe the CPU. Must be set before numpy/faiss load.
+CPU_SHARE = max(1, (os.cpu_count() or 1) // EMBEDDING_WORKERS)
+for var in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+    os.environ.setdefault(var, str(CPU_SHARE))
+
+import atexit
+import base64
+import fcntl
 import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache
 import numpy as np
 import faiss
+import onnxruntime as ort
+import orjson
+import torch
 from flask import Flask, request, jsonify
-from sentence_transformers import SentenceTransformer
-import traceback
+from flask.json.provider import JSONProvider
+from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+from logging_config import get_logger
+
+
+class ORJSONProvider(JSONProvider):
+    """JSON provider backed by orjson; NumPy arrays serialize without tolist()"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+logger = get_logger("embedding")
 
 # Configuration
 EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+# "onnx" runs a dynamically INT8-quantized export through ONNX Runtime, "torch" the FP32 model
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "onnx")
+# Quantization target: arm64, avx2, avx512 or avx512_vnni
+EMBEDDING_QUANTIZATION = os.environ.get("EMBEDDING_QUANTIZATION", "avx512_vnni")
+MODEL_DIR = os.environ.get("MODEL_DIR", "/app/models")
+# Intra-op threads for the embedding model (inter-op parallelism is disabled)
+EMBEDDING_THREADS = int(os.environ.get("EMBEDDING_THREADS", CPU_SHARE))
+# OpenMP threads FAISS uses for a search or add
+FAISS_THREADS = int(os.environ.get("FAISS_THREADS", CPU_SHARE))
 FAISS_INDEX_PATH = os.environ.get("FAISS_INDEX_PATH", "/app/storage/faiss_index")
-METADATA_PATH = os.environ.get("METADATA_PATH", "/app/storage/faiss_metadata.json")
+METADATA_PATH = os.environ.get("METADATA_PATH", "/app/storage/faiss_metadata.npy")
+# A .json path names the legacy metadata file; the table lives next to it
+LEGACY_METADATA_PATH = os.path.splitext(METADATA_PATH)[0] + ".json"
+METADATA_PATH = os.path.splitext(METADATA_PATH)[0] + ".npy"
+PENDING_PATH = FAISS_INDEX_PATH + ".pending.npy"
+INDEX_STATE_PATH = FAISS_INDEX_PATH + ".json"
+METADATA_CHUNK = 65536  # rows; the metadata file grows in multiples of this
+# Saves run in the background, coalescing /index calls made within this delay
+FAISS_SAVE_DELAY = float(os.environ.get("FAISS_SAVE_DELAY_MS", 1000)) / 1000
+# With FAISS_MMAP, a writer keeps its in-memory copy until no vectors have been
+# added for this long, then maps the saved file again
+FAISS_REMAP_DELAY = float(os.environ.get("FAISS_REMAP_DELAY_MS", 30000)) / 1000
+
+# Micro-batching of concurrent /embed requests
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", 64))
+EMBED_BATCH_MAX_ITEMS = int(os.environ.get("EMBED_BATCH_MAX_ITEMS", 128))
+EMBED_BATCH_WINDOW = float(os.environ.get("EMBED_BATCH_WINDOW_MS", 10)) / 1000
+# Seconds a request waits for its batch to be encoded
+EMBED_TIMEOUT = float(os.environ.get("EMBED_TIMEOUT", 300))
+
+# Number of distinct search queries whose embeddings are kept in memory
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", 4096))
+
+# ANN index configuration (any faiss.index_factory string, e.g. "HNSW32" or "IVF1024,PQ32x8").
+# The default stores vectors as fp16 (768 bytes instead of 1536 per vector).
+EMBEDDING_DIM = 384  # MiniLM dimension
+# Bump when the stored vectors or metric change; older indexes are rebuilt on load
+INDEX_VERSION = 3
+FAISS_INDEX_FACTORY = os.environ.get("FAISS_INDEX_FACTORY", "HNSW32,SQfp16")
+FAISS_TRAIN_SIZE = int(os.environ.get("FAISS_TRAIN_SIZE", 10000))
+FAISS_EF_SEARCH = int(os.environ.get("FAISS_EF_SEARCH", 64))
+FAISS_NPROBE = int(os.environ.get("FAISS_NPROBE", 16))
+# Vectors of storage headroom for new in-memory (FAISS_MMAP=false) indexes and
+# the default amount for /reserve
+FAISS_RESERVE = int(os.environ.get("FAISS_RESERVE", 100000))
+# Memory-map the saved index read-only instead of reading it into RAM
+FAISS_MMAP = os.environ.get("FAISS_MMAP", "true").lower() == "true"
+# IVF indexes map their inverted lists, the others their flat code storage
+FAISS_MMAP_FLAGS = faiss.IO_FLAG_READ_ONLY | (
+    faiss.IO_FLAG_MMAP if "IVF" in FAISS_INDEX_FACTORY else faiss.IO_FLAG_MMAP_IFC
+)
+
+NO_VIDEO = -1  # video_ids value for vectors indexed without a video
+
+
+def round_capacity(rows):
+    """Round a metadata row count up to a whole number of METADATA_CHUNK rows"""
+    return max(1, -(-rows // METADATA_CHUNK)) * METADATA_CHUNK
+
+
+@dataclass
+class MetaTable:
+    """
+    Transcript and video ids per FAISS index position.
+
+    Stored as parallel int64 arrays (row i describes index position i) so
+    lookups are plain NumPy indexing. Both arrays are the rows of a
+    (2, capacity) memory-mapped .npy file: appends write straight into the
+    mapping and saving only flushes it. The file grows geometrically in
+    METADATA_CHUNK steps; only the first `size` rows are valid.
+    `video_positions` maps each video id to its index positions for
+    filtered searches.
+    """
+
+    path: str
+    transcript_ids: np.ndarray
+    video_ids: np.ndarray
+    size: int = 0
+    video_positions: dict = field(default_factory=dict)
+
+    def __post_init__(self):
+        if self.size and not self.video_positions:
+            order = np.argsort(self.video_ids[: self.size], kind="stable")
+            videos, starts = np.unique(self.video_ids[order], return_index=True)
+            self.video_positions = dict(zip(videos.tolist(), np.split(order, starts[1:])))
+
+    def __len__(self):
+        return self.size
+
+    @staticmethod
+    def allocate(path, capacity, transcript_ids=(), video_ids=()):
+        """Atomically write a new (2, capacity) table file seeded with the given rows"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        storage = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.int64, shape=(2, capacity)
+        )
+        storage[0, : len(transcript_ids)] = transcript_ids
+        storage[1, : len(video_ids)] = video_ids
+        storage.flush()
+        os.replace(tmp_path, path)
+        return storage
+
+    @classmethod
+    def create(cls, path, transcript_ids=(), video_ids=()):
+        """Create a table file at `path`, replacing any existing one"""
+        size = len(transcript_ids)
+        storage = cls.allocate(path, round_capacity(size), transcript_ids, video_ids)
+        return cls(path, storage[0], storage[1], size)
+
+    @classmethod
+    def open(cls, path, size):
+        """Map an existing table file, keeping the first `size` rows"""
+        storage = np.lib.format.open_memmap(path, mode="r+")
+        return cls(path, storage[0], storage[1], min(size, storage.shape[1]))
+
+    @classmethod
+    def load_json(cls, json_path, path):
+        """Convert the legacy JSON metadata dict; returns (table, index version)"""
+        with open(json_path, "r") as f:
+            saved = json.load(f)
+
+        if "version" in saved:
+            version, entries = saved["version"], saved["entries"]
+        else:
+            version, entries = 1, saved
+
+        size = max((int(pos) for pos in entries), default=-1) + 1
+        transcript_ids = np.full(size, -1, dtype=np.int64)
+        video_ids = np.full(size, NO_VIDEO, dtype=np.int64)
+        for pos, meta in entries.items():
+            transcript_ids[int(pos)] = meta["transcript_id"]
+            if meta.get("video_id") is not None:
+                video_ids[int(pos)] = meta["video_id"]
+
+        return cls.create(path, transcript_ids, video_ids), version
+
+    def append(self, transcript_ids, video_id):
+        """Append rows for consecutive index positions sharing one video"""
+        count = len(transcript_ids)
+        needed = self.size + count
+
+        if needed > len(self.transcript_ids):
+            capacity = round_capacity(max(needed, 2 * len(self.transcript_ids)))
+            storage = self.allocate(
+                self.path,
+                capacity,
+                self.transcript_ids[: self.size],
+                self.video_ids[: self.size],
+            )
+            self.transcript_ids, self.video_ids = storage[0], storage[1]
+
+        self.transcript_ids[self.size:needed] = transcript_ids
+        video = NO_VIDEO if video_id is None else int(video_id)
+        self.video_ids[self.size:needed] = video
+
+        positions = np.arange(self.size, needed, dtype=np.int64)
+        if video in self.video_positions:
+            positions = np.concatenate([self.video_positions[video], positions])
+        self.video_positions[video] = positions
+
+        self.size = needed
+
+    def flush(self):
+        """Write appended rows back to the table file"""
+        # Both arrays are views of the same mapping
+        self.transcript_ids.flush()
+
 
 # Global variables
 model = None
+model_lock = threading.Lock()
 faiss_index = None
-metadata = {}  # Maps FAISS index position to transcript_id
+# Save generation (from faiss_index.json) of the index this process last loaded or saved
+loaded_generation = None
+index_mapped = False  # True while faiss_index is a read-only mapping of the index file
+reserved_capacity = 0  # Keep the index in memory (unmapped) until it holds this many vectors
+index_dirty = False  # True while the in-memory index has changes not yet saved
+metadata = None  # MetaTable mapping FAISS index position to transcript/video ids
+index_lock = threading.RLock()  # Serializes index mutations and snapshots
+encode_queue = queue.Queue()  # (texts, future) pairs waiting to be encoded
+encode_worker = None
+active_encode_requests = 0  # encode_texts() calls waiting for their batch
+save_requested = threading.Event()
+save_worker = None
+index_written = threading.Event()  # Set by every add, restarts the remap idle timer
+remap_worker = None
+worker_lock = threading.Lock()
+# Vectors buffered until the index is trained (IVF/PQ indexes only)
+pending_vectors = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+
+def load_quantized_onnx_model():
+    """
+    Load the INT8-quantized ONNX export of the embedding model.
+
+    The first run exports the model to ONNX, applies dynamic INT8
+    quantization and caches the result under MODEL_DIR; later runs load
+    the cached file directly.
+    """
+    cache_dir = os.path.join(MODEL_DIR, EMBEDDING_MODEL.replace("/", "_") + "-onnx")
+    file_name = f"onnx/model_qint8_{EMBEDDING_QUANTIZATION}.onnx"
+
+    # Only one worker exports, the others wait and load the cached file
+    with file_lock(cache_dir + ".lock"):
+        if not os.path.exists(os.path.join(cache_dir, file_name)):
+            logger.info(
+                "Exporting %s to quantized ONNX (%s)", EMBEDDING_MODEL, EMBEDDING_QUANTIZATION
+            )
+            onnx_model = SentenceTransformer(EMBEDDING_MODEL, backend="onnx")
+            onnx_model.save(cache_dir)
+            export_dynamic_quantized_onnx_model(onnx_model, EMBEDDING_QUANTIZATION, cache_dir)
+
+    return SentenceTransformer(
+        cache_dir,
+        backend="onnx",
+        model_kwargs={"file_name": file_name, "session_options": ort_session_options()},
+    )
+
+
+def ort_session_options():
+    """ONNX Runtime options: fully optimized graph, one fixed-size intra-op pool"""
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = EMBEDDING_THREADS
+    options.inter_op_num_threads = 1
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    return options
+
+
+def configure_torch_threads():
+    """Pin PyTorch to EMBEDDING_THREADS intra-op threads and no inter-op pool"""
+    torch.set_num_threads(EMBEDDING_THREADS)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set before the first parallel PyTorch operation
+        pass
 
 
 def get_model():
     """Load the sentence transformer model"""
     global model
-    if model is None:
-        print(f"Loading embedding model: {EMBEDDING_MODEL}")
-        model = SentenceTransformer(EMBEDDING_MODEL)
-        print("Embedding model loaded successfully")
+    with model_lock:
+        if model is None:
+            logger.info("Loading embedding model: %s (%s)", EMBEDDING_MODEL, EMBEDDING_BACKEND)
+            configure_torch_threads()
+            if EMBEDDING_BACKEND == "onnx":
+                model = load_quantized_onnx_model()
+            else:
+                model = SentenceTransformer(EMBEDDING_MODEL)
+            logger.info("Embedding model loaded successfully")
     return model
 
 
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive flock on `path`, shared by all worker processes"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def encode_worker_loop():
+    """
+    Coalesce queued encode requests into single model calls.
+
+    Waits up to EMBED_BATCH_WINDOW after the first request for more to
+    arrive (at most EMBED_BATCH_MAX_ITEMS texts), encodes the unique texts
+    of all collected requests in one pass and hands each request its rows.
+    The wait is skipped when no other encode_texts() call is in progress,
+    e.g. in single-threaded gunicorn workers.
+    """
+    while True:
+        jobs = [encode_queue.get()]
+
+        # Any failure resolves the collected requests instead of killing the thread
+        try:
+            item_count = len(jobs[0][0])
+            deadline = time.monotonic() + EMBED_BATCH_WINDOW
+
+            while item_count < EMBED_BATCH_MAX_ITEMS:
+                if encode_queue.empty() and active_encode_requests <= len(jobs):
+                    break
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    job = encode_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                jobs.append(job)
+                item_count += len(job[0])
+
+            # Deduplicate texts across all collected requests
+            positions = {}
+            for texts, _ in jobs:
+                for text in texts:
+                    positions.setdefault(text, len(positions))
+
+            embeddings = get_model().encode(
+                list(positions),
+                batch_size=EMBED_BATCH_SIZE,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+            )
+
+            for texts, future in jobs:
+                future.set_result(embeddings[[positions[text] for text in texts]])
+        except Exception as e:
+            logger.exception("Encoding batch failed")
+            for _, future in jobs:
+                if not future.done():
+                    future.set_exception(e)
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def embed_query(text):
+    """Embed a search query as float32 bytes; cached because popular queries repeat"""
+    embedding = get_model().encode(
+        [text], normalize_embeddings=True, show_progress_bar=False
+    )
+    return np.asarray(embedding, dtype=np.float32).tobytes()
+
+
+def embed_queries(queries):
+    """
+    Embed search queries as an (nq, EMBEDDING_DIM) float32 array.
+
+    A single query goes through the query cache; several queries are
+    encoded together through the micro-batcher.
+    """
+    # Whitespace-normalized text is the cache key
+    queries = [" ".join(query.split()) for query in queries]
+    if len(queries) == 1:
+        return np.frombuffer(embed_query(queries[0]), dtype=np.float32).reshape(1, EMBEDDING_DIM)
+    return encode_texts(queries)
+
+
+def ensure_thread(thread, target):
+    """Return `thread` if it is running, otherwise start a daemon thread for `target`"""
+    if thread is None or not thread.is_alive():
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+    return thread
+
+
+def encode_texts(texts):
+    """Encode texts through the shared micro-batcher"""
+    global encode_worker, active_encode_requests
+
+    with worker_lock:
+        encode_worker = ensure_thread(encode_worker, encode_worker_loop)
+        active_encode_requests += 1
+
+    try:
+        future = Future()
+        encode_queue.put((texts, future))
+        return future.result(timeout=EMBED_TIMEOUT)
+    finally:
+        with worker_lock:
+            active_encode_requests -= 1
+
+
+def is_integer(value):
+    """Check that a JSON value is an integer (ids are stored as int64)"""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def ids_error(ids, video_id=None):
+    """Describe what is wrong with transcript/video ids, or return None if they are valid"""
+    if not all(is_integer(seg_id) for seg_id in ids):
+        return "ids must be integers"
+    if video_id is not None and not is_integer(video_id):
+        return "video_id must be an integer"
+    return None
+
+
+def segments_error(segments):
+    """Describe what is wrong with a segments list, or return None if it is valid"""
+    if not isinstance(segments, list):
+        return "segments must be a list"
+    for seg in segments:
+        if not isinstance(seg, dict) or not isinstance(seg.get("text"), str):
+            return "each segment needs an id and a string text"
+    return ids_error([seg.get("id") for seg in segments])
+
+
+def encode_vectors(vectors):
+    """Serialize an (N, EMBEDDING_DIM) array as base64 of its float32 bytes"""
+    raw = np.ascontiguousarray(vectors, dtype=np.float32).tobytes()
+    return base64.b64encode(raw).decode("ascii")
+
+
+def decode_vectors(data):
+    """Inverse of encode_vectors; returns a writable (N, EMBEDDING_DIM) array"""
+    raw = bytearray(base64.b64decode(data))
+    return np.frombuffer(raw, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+
+
+def create_faiss_index():
+    """
+    Create an empty ANN index from FAISS_INDEX_FACTORY.
+
+    Vectors are stored L2-normalized, so inner product is cosine similarity.
+    """
+    logger.info("Creating new FAISS index (%s)", FAISS_INDEX_FACTORY)
+    index = faiss.index_factory(
+        EMBEDDING_DIM, FAISS_INDEX_FACTORY, faiss.METRIC_INNER_PRODUCT
+    )
+    configure_search_params(index)
+    # A mapped index is replaced by the saved file on the first save anyway
+    if not FAISS_MMAP:
+        reserve_faiss_index(index, FAISS_RESERVE)
+    return index
+
+
+def reserve_vector(vector, size):
+    """Grow a FAISS vector's capacity to at least `size` elements, keeping its length"""
+    length = vector.size()
+    if size > length:
+        # Shrinking a std::vector keeps its allocation
+        vector.resize(size)
+        vector.resize(length)
+
+
+def reserve_faiss_index(index, capacity):
+    """
+    Preallocate room for `capacity` vectors in an in-memory index.
+
+    Adding past the capacity of the flat code storage (and the HNSW graph
+    arrays) reallocates and copies all of it; reserving up front turns
+    those copies into one allocation. Returns False for indexes whose
+    storage cannot be reserved (IVF lists, memory-mapped codes).
+    """
+    storage = faiss.downcast_index(index.storage) if hasattr(index, "hnsw") else index
+    if not hasattr(storage, "codes") or not storage.codes.is_owned:
+        return False
+
+    reserve_vector(storage.codes, capacity * storage.code_size)
+
+    if hasattr(index, "hnsw"):
+        hnsw = index.hnsw
+        reserve_vector(hnsw.neighbors, capacity * hnsw.nb_neighbors(0))
+        reserve_vector(hnsw.levels, capacity)
+        reserve_vector(hnsw.offsets, capacity + 1)
+
+    return True
+
+
+def configure_search_params(index):
+    """Apply query-time recall/speed knobs (efSearch for HNSW, nprobe for IVF)"""
+    if hasattr(index, "hnsw"):
+        index.hnsw.efSearch = FAISS_EF_SEARCH
+
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = FAISS_NPROBE
+
+
+def search_positions(index, query_vectors, k, positions):
+    """
+    Search only the given index positions.
+
+    HNSW graph traversal loses most of its recall under a restrictive
+    filter, so HNSW indexes are searched exhaustively over their vector
+    storage, scoring only the selected positions. IVF indexes apply the
+    selector inside the probed inverted lists.
+    """
+    selector = faiss.IDSelectorBatch(positions)
+
+    if hasattr(index, "hnsw"):
+        storage = faiss.downcast_index(index.storage)
+        return storage.search(query_vectors, k, params=faiss.SearchParameters(sel=selector))
+
+    if faiss.try_extract_index_ivf(index) is not None:
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=FAISS_NPROBE)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    return index.search(query_vectors, k, params=params)
+
+
+def format_results(indices, distances):
+    """Turn one row of FAISS search output into result dicts"""
+    # Drop empty slots and positions without metadata
+    mask = (indices >= 0) & (indices < len(metadata))
+    selected = indices[mask]
+
+    # Gather ids and scores column-wise (inner product of normalized vectors
+    # is the cosine similarity), then convert to Python objects in one pass
+    transcript_ids = metadata.transcript_ids[selected].tolist()
+    video_ids = metadata.video_ids[selected].tolist()
+    similarities = distances[mask].astype(np.float64).round(4).tolist()
+
+    return [
+        {
+            "transcript_id": transcript_id,
+            "video_id": None if vid == NO_VIDEO else vid,
+            "similarity": similarity,
+        }
+        for transcript_id, vid, similarity in zip(transcript_ids, video_ids, similarities)
+    ]
+
+
 def get_faiss_index():
-    """Get or create FAISS index"""
-    global faiss_index, metadata
+    """Get or create FAISS index, reloading it if another worker saved a newer one"""
+    if faiss_index is None or index_file_changed():
+        with index_lock:
+            if faiss_index is None or index_file_changed():
+                load_faiss_index()
+
+    return faiss_index
+
+
+def index_file_changed():
+    """Check whether another worker has saved the index since this one loaded it"""
+    if EMBEDDING_WORKERS == 1:
+        return False
 
-    if faiss_index is None:
-        embedding_dim = 384  # MiniLM dimension
+    return load_index_state()["generation"] != loaded_generation
 
-        # Try to load existing index
-        if os.path.exists(FAISS_INDEX_PATH):
-            print(f"Loading existing FAISS index from {FAISS_INDEX_PATH}")
-            faiss_index = faiss.read_index(FAISS_INDEX_PATH)
 
-            # Load metadata
-            if os.path.exists(METADATA_PATH):
-                with open(METADATA_PATH, "r") as f:
-                    metadata = json.load(f)
+def load_faiss_index(mmap=FAISS_MMAP):
+    """Load the index, metadata and pending vectors from disk, or create them"""
+    global faiss_index, metadata, pending_vectors, loaded_generation, index_mapped
+    global reserved_capacity, index_dirty
+
+    # Any storage reserved in the previous copy, or unsaved change, is gone
+    reserved_capacity = 0
+    index_dirty = False
+
+    # Read the state before the index: a save replaces the index first
+    state = load_index_state()
+    loaded_generation = state["generation"]
+
+    # Try to load existing index
+    if os.path.exists(FAISS_INDEX_PATH):
+        logger.info("Loading existing FAISS index from %s", FAISS_INDEX_PATH)
+        faiss_index = read_faiss_index(mmap)
+        index_mapped = mmap
+
+        # Load vectors still waiting for index training
+        pending_vectors = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        if os.path.exists(PENDING_PATH):
+            pending_vectors = np.load(PENDING_PATH)
+
+        # Load metadata; rows appended after the last index save are dropped
+        saved_rows = faiss_index.ntotal + len(pending_vectors)
+        if os.path.exists(METADATA_PATH):
+            metadata = MetaTable.open(METADATA_PATH, saved_rows)
+            version = state["version"]
+        elif os.path.exists(LEGACY_METADATA_PATH):
+            metadata, version = MetaTable.load_json(LEGACY_METADATA_PATH, METADATA_PATH)
         else:
-            print("Creating new FAISS index")
-            # Use L2 distance (Euclidean) - can also use IndexFlatIP for cosine similarity
-            faiss_index = faiss.IndexFlatL2(embedding_dim)
+            metadata, version = MetaTable.create(METADATA_PATH), 1
+
+        if version != INDEX_VERSION:
+            logger.info("FAISS index version %s is outdated, rebuilding", version)
+            faiss_index = rebuild_faiss_index(faiss_index)
+            index_mapped = False
+            save_faiss_index()
+            if mmap:
+                map_saved_index()
+    else:
+        faiss_index = create_faiss_index()
+        index_mapped = False
+        metadata = MetaTable.create(METADATA_PATH)
+
+
+def read_faiss_index(mmap):
+    """Read the saved index, optionally as a read-only memory mapping"""
+    if mmap:
+        index = faiss.read_index(FAISS_INDEX_PATH, FAISS_MMAP_FLAGS)
+    else:
+        index = faiss.read_index(FAISS_INDEX_PATH)
+    configure_search_params(index)
+    return index
+
+
+def get_writable_faiss_index():
+    """
+    Get the index for adding vectors.
+
+    A read-only mapping cannot be modified, so it is replaced by an
+    in-memory copy. The copy is kept across saves and only mapped again
+    once writes have been idle for FAISS_REMAP_DELAY (see remap_worker_loop).
+    """
+    global faiss_index, index_mapped
+
+    if faiss_index is None or index_file_changed():
+        # Another worker saved: read its index straight into memory
+        load_faiss_index(mmap=False)
+    elif index_mapped:
+        faiss_index = read_faiss_index(mmap=False)
+        index_mapped = False
 
     return faiss_index
 
 
+def map_saved_index():
+    """Replace the in-memory index by a read-only mapping of the saved file"""
+    global faiss_index, index_mapped
+
+    with index_lock:
+        # Keep unsaved changes, a /reserve'd copy, or an index another
+        # worker has replaced (it is reloaded on the next access)
+        if (
+            index_mapped
+            or index_dirty
+            or faiss_index.ntotal < reserved_capacity
+            or index_file_changed()
+        ):
+            return
+        faiss_index = read_faiss_index(mmap=True)
+        index_mapped = True
+
+
+def remap_worker_loop():
+    """Map the saved index again once no vectors were added for FAISS_REMAP_DELAY"""
+    while True:
+        index_written.wait()
+        index_written.clear()
+        # Every add during the delay restarts it
+        while index_written.wait(timeout=FAISS_REMAP_DELAY):
+            index_written.clear()
+
+        try:
+            map_saved_index()
+        except Exception:
+            logger.exception("Mapping FAISS index failed")
+
+        # A save may still have been pending; try again after another delay
+        if not index_mapped:
+            with index_lock:
+                if index_dirty:
+                    index_written.set()
+
+
+def rebuild_faiss_index(old_index):
+    """Re-add the vectors of an outdated index, L2-normalized, to a new index"""
+    global metadata, pending_vectors
+
+    index = create_faiss_index()
+
+    try:
+        vectors = old_index.reconstruct_n(0, old_index.ntotal)
+    except RuntimeError as e:
+        logger.warning("Cannot reconstruct vectors from old index, starting empty: %s", e)
+        metadata = MetaTable.create(METADATA_PATH)
+        pending_vectors = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+        return index
+
+    vectors = np.ascontiguousarray(np.vstack([vectors, pending_vectors]))
+    pending_vectors = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+    faiss.normalize_L2(vectors)
+    add_vectors(index, vectors)
+    return index
+
+
+def add_vectors(index, vectors):
+    """
+    Add vectors to the index.
+
+    Indexes that need training (IVF/PQ) buffer vectors until FAISS_TRAIN_SIZE
+    have accumulated, then train on the buffer and add it in one go. Buffered
+    vectors keep their future index positions, so metadata can be assigned
+    up front.
+    """
+    global pending_vectors
+
+    if index.is_trained:
+        index.add(vectors)
+        return
+
+    pending_vectors = np.vstack([pending_vectors, vectors])
+
+    if len(pending_vectors) >= FAISS_TRAIN_SIZE:
+        logger.info("Training FAISS index on %d vectors", len(pending_vectors))
+        index.train(pending_vectors)
+        index.add(pending_vectors)
+        pending_vectors = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+
+def load_index_state():
+    """
+    Read the saved index state: the INDEX_VERSION it was written with and
+    its save generation, which every save increments.
+    """
+    if not os.path.exists(INDEX_STATE_PATH):
+        return {"version": 1, "generation": 0}
+    with open(INDEX_STATE_PATH, "r") as f:
+        state = json.load(f)
+    state.setdefault("generation", 0)
+    return state
+
+
+def add_to_index(vectors, ids, video_id):
+    """
+    Add normalized vectors for the given transcript ids.
+
+    Returns the number of indexed vectors, including those buffered until
+    an IVF/PQ index is trained.
+    """
+    global index_dirty, remap_worker
+
+    # Convert ids before touching the index, so a bad id cannot leave
+    # vectors without metadata rows
+    ids = np.asarray(ids, dtype=np.int64)
+    video_id = None if video_id is None else int(video_id)
+
+    with index_lock, file_lock(FAISS_INDEX_PATH + ".lock"):
+        # Get FAISS index (including changes saved by other workers)
+        index = get_writable_faiss_index()
+
+        # Add to index
+        add_vectors(index, vectors)
+        index_dirty = True
+
+        # Update metadata (rows line up with index positions, including buffered vectors)
+        metadata.append(ids, video_id)
+
+        # Save index
+        persist_index()
+
+        total = index.ntotal + len(pending_vectors)
+
+    if FAISS_MMAP:
+        with worker_lock:
+            remap_worker = ensure_thread(remap_worker, remap_worker_loop)
+        index_written.set()
+
+    logger.debug("Indexed %d vectors. Total: %d", len(ids), total)
+    return total
+
+
 def save_faiss_index():
     """Save FAISS index and metadata to disk"""
-    global faiss_index, metadata
+    global loaded_generation, index_dirty
+
+    with index_lock:
+        if faiss_index is None:
+            return
 
-    if faiss_index is not None:
         # Ensure directory exists
         os.makedirs(os.path.dirname(FAISS_INDEX_PATH), exist_ok=True)
 
-        # Save index
-        faiss.write_index(faiss_index, FAISS_INDEX_PATH)
+        # Metadata rows are already in the mapped file, flush them first
+        metadata.flush()
+
+        # Save vectors waiting for training
+        if len(pending_vectors):
+            np.save(PENDING_PATH + ".tmp.npy", pending_vectors)
+            os.replace(PENDING_PATH + ".tmp.npy", PENDING_PATH)
+        elif os.path.exists(PENDING_PATH):
+            os.remove(PENDING_PATH)
+
+        # Save index via a temporary file so readers never see a partial write
+        faiss.write_index(faiss_index, FAISS_INDEX_PATH + ".tmp")
+        os.replace(FAISS_INDEX_PATH + ".tmp", FAISS_INDEX_PATH)
+
+        # Bump the generation last, so a worker that sees it reloads the new
+        # files; the sidecar is read without the file lock, so replace it atomically
+        generation = load_index_state()["generation"] + 1
+        with open(INDEX_STATE_PATH + ".tmp", "w") as f:
+            json.dump({"version": INDEX_VERSION, "generation": generation}, f)
+        os.replace(INDEX_STATE_PATH + ".tmp", INDEX_STATE_PATH)
+        loaded_generation = generation
+        index_dirty = False
+
+        logger.info("FAISS index saved with %d vectors", faiss_index.ntotal)
+
 
-        # Save metadata
-        with open(METADATA_PATH, "w") as f:
-            json.dump(metadata, f)
+def save_worker_loop():
+    """Save the index in the background whenever a save has been requested"""
+    while True:
+        save_requested.wait()
+        # Let a burst of /index calls settle into a single save
+        time.sleep(FAISS_SAVE_DELAY)
+        save_requested.clear()
 
-        print(f"FAISS index saved with {faiss_index.ntotal} vectors")
+        try:
+            save_faiss_index()
+        except Exception:
+            logger.exception("Saving FAISS index failed")
+
+
+def schedule_save():
+    """Request a background save of the index"""
+    global save_worker
+
+    with worker_lock:
+        save_worker = ensure_thread(save_worker, save_worker_loop)
+    save_requested.set()
+
+
+def persist_index():
+    """
+    Persist an index mutation.
+
+    A single worker saves in the background. With several workers (the
+    Docker default on multi-core hosts) the save is synchronous: it has to
+    finish before the caller releases the index file lock, so the next
+    writer reloads the index including this change. Each /index or
+    /ingest call then pays for writing the whole index, but not for
+    reading it back: the writer keeps its in-memory copy.
+    """
+    if EMBEDDING_WORKERS > 1:
+        save_faiss_index()
+    else:
+        schedule_save()
+
+
+@atexit.register
+def flush_scheduled_save():
+    """Write out a save that is still pending when the process exits"""
+    if save_requested.is_set():
+        save_faiss_index()
+
+
+@app.before_request
+def configure_faiss_threads():
+    """Use FAISS_THREADS OpenMP threads in the thread serving this request"""
+    # Not done at import: the gunicorn --preload parent must stay single-threaded
+    faiss.omp_set_num_threads(FAISS_THREADS)
 
 
 @app.route("/health", methods=["GET"])
@@ -85,6 +891,8 @@ def health():
             "status": "ok",
             "model": EMBEDDING_MODEL,
             "index_size": index.ntotal if index else 0,
+            "query_cache": embed_query.cache_info()._asdict(),
+            "faiss_threads": faiss.omp_get_max_threads(),
         }
     )
 
@@ -99,9 +907,13 @@ def embed():
         "segments": [
             {"id": 1, "text": "Hello world"},
             {"id": 2, "text": "Another segment"}
-        ]
+        ],
+        "format": "raw",  // optional, return a base64 float32 blob
+        "video_id": 1  // required with ?inline_index=1
     }
 
+    With ?inline_index=1 the request is handled by /ingest.
+
     Response JSON:
     {
         "embeddings": [
@@ -109,6 +921,12 @@ def embed():
             {"id": 2, "embedding": [0.3, 0.4, ...]}
         ]
     }
+
+    Response JSON (format "raw"):
+    {
+        "ids": [1, 2],
+        "embeddings_b64": "<base64 of row-major float32 (N, 384) array>"
+    }
     """
     try:
         data = request.get_json()
@@ -116,35 +934,45 @@ def embed():
         if not data or "segments" not in data:
             return jsonify({"error": "segments is required"}), 400
 
+        inline_index = request.args.get("inline_index", "false").lower()
+        if inline_index in ("1", "true", "yes"):
+            if data.get("video_id") is None:
+                return jsonify({"error": "video_id is required with inline_index"}), 400
+            return ingest()
+
         segments = data["segments"]
 
+        error = segments_error(segments)
+        if error:
+            return jsonify({"error": error}), 400
+
         if not segments:
             return jsonify({"embeddings": []})
 
-        # Get model
-        embedding_model = get_model()
-
         # Extract texts
         texts = [seg["text"] for seg in segments]
         ids = [seg["id"] for seg in segments]
 
-        print(f"Generating embeddings for {len(texts)} segments")
+        logger.debug("Generating embeddings for %d segments", len(texts))
+
+        # Generate embeddings (batched with concurrent requests)
+        embeddings = encode_texts(texts)
 
-        # Generate embeddings
-        embeddings = embedding_model.encode(texts, show_progress_bar=False)
+        logger.debug("Generated %d embeddings", len(embeddings))
 
-        # Format response
-        result = []
-        for i, (seg_id, embedding) in enumerate(zip(ids, embeddings)):
-            result.append({"id": seg_id, "embedding": embedding.tolist()})
+        if data.get("format") == "raw":
+            return jsonify({"ids": ids, "embeddings_b64": encode_vectors(embeddings)})
 
-        print(f"Generated {len(result)} embeddings")
+        # Format response (rows are serialized by orjson directly)
+        result = [
+            {"id": seg_id, "embedding": embedding}
+            for seg_id, embedding in zip(ids, embeddings)
+        ]
 
         return jsonify({"embeddings": result})
 
     except Exception as e:
-        print(f"Embedding error: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Embedding failed")
         return jsonify({"error": str(e)}), 500
 
 
@@ -161,56 +989,118 @@ def index_embeddings():
             {"id": 2, "embedding": [0.3, 0.4, ...]}
         ]
     }
+
+    or, with the "raw" output of /embed:
+    {
+        "video_id": 1,
+        "ids": [1, 2],
+        "embeddings_b64": "<base64 of row-major float32 (N, 384) array>"
+    }
     """
     try:
-        global metadata
-
         data = request.get_json()
 
-        if not data or "embeddings" not in data:
+        if not data or ("embeddings" not in data and "embeddings_b64" not in data):
             return jsonify({"error": "embeddings is required"}), 400
 
         video_id = data.get("video_id")
-        embeddings_data = data["embeddings"]
 
-        if not embeddings_data:
+        # Prepare vectors
+        if "embeddings_b64" in data:
+            ids = data.get("ids", [])
+            vectors = decode_vectors(data["embeddings_b64"])
+            if len(ids) != len(vectors):
+                return jsonify({"error": "ids and embeddings_b64 lengths differ"}), 400
+        else:
+            ids = [e["id"] for e in data["embeddings"]]
+            vectors = np.array(
+                [e["embedding"] for e in data["embeddings"]], dtype=np.float32
+            )
+
+        if not ids:
             return jsonify({"message": "No embeddings to index"})
 
-        # Get FAISS index
-        index = get_faiss_index()
+        error = ids_error(ids, video_id)
+        if error:
+            return jsonify({"error": error}), 400
 
-        # Prepare vectors
-        vectors = np.array([e["embedding"] for e in embeddings_data], dtype=np.float32)
+        faiss.normalize_L2(vectors)
+        total = add_to_index(vectors, ids, video_id)
 
-        # Get starting index
-        start_idx = index.ntotal
+        return jsonify(
+            {
+                "message": f"Indexed {len(ids)} vectors",
+                "total_vectors": total,
+            }
+        )
 
-        # Add to index
-        index.add(vectors)
+    except Exception as e:
+        logger.exception("Indexing failed")
+        return jsonify({"error": str(e)}), 500
 
-        # Update metadata
-        for i, emb in enumerate(embeddings_data):
-            faiss_idx = start_idx + i
-            metadata[str(faiss_idx)] = {
-                "transcript_id": emb["id"],
-                "video_id": video_id,
-            }
 
-        # Save index
-        save_faiss_index()
+@app.route("/ingest", methods=["POST"])
+def ingest():
+    """
+    Embed text segments and add them to the FAISS index in one call
+
+    The vectors stay in NumPy from the model to the index, skipping the
+    JSON round trip of /embed followed by /index.
+
+    Request JSON:
+    {
+        "video_id": 1,  // optional
+        "segments": [
+            {"id": 1, "text": "Hello world"},
+            {"id": 2, "text": "Another segment"}
+        ]
+    }
+
+    Response JSON:
+    {
+        "message": "Indexed 2 vectors",
+        "total_vectors": 100
+    }
+    """
+    try:
+        data = request.get_json()
+
+        if not data or "segments" not in data:
+            return jsonify({"error": "segments is required"}), 400
+
+        segments = data["segments"]
+        video_id = data.get("video_id")
+
+        error = segments_error(segments) or ids_error([], video_id)
+        if error:
+            return jsonify({"error": error}), 400
+
+        if not segments:
+            return jsonify(
+                {
+                    "message": "Indexed 0 vectors",
+                    "total_vectors": get_faiss_index().ntotal + len(pending_vectors),
+                }
+            )
+
+        texts = [seg["text"] for seg in segments]
+        ids = [seg["id"] for seg in segments]
+
+        logger.debug("Ingesting %d segments", len(texts))
 
-        print(f"Indexed {len(embeddings_data)} vectors. Total: {index.ntotal}")
+        # Embeddings come back L2-normalized, ready for the inner-product index
+        embeddings = encode_texts(texts)
+        total = add_to_index(embeddings, ids, video_id)
 
         return jsonify(
             {
-                "message": f"Indexed {len(embeddings_data)} vectors",
-                "total_vectors": index.ntotal,
+                "message": f"Indexed {len(ids)} vectors",
+                "total_vectors": total,
             }
         )
 
     except Exception as e:
-        print(f"Indexing error: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Ingest failed")
         return jsonify({"error": str(e)}), 500
 
 
@@ -221,7 +1111,7 @@ def search():
 
     Request JSON:
     {
-        "query": "search query text",
+        "query": "search query text",  // or "queries": ["first", "second"]
         "video_id": 1,  // optional, filter by video
         "top_k": 10
     }
@@ -233,98 +1123,136 @@ def search():
             {"transcript_id": 2, "similarity": 0.87}
         ]
     }
+
+    With "queries", "results" holds one such list per query, in order.
+    All queries are embedded and searched in a single batch.
     """
     try:
         data = request.get_json()
 
-        if not data or "query" not in data:
-            return jsonify({"error": "query is required"}), 400
+        if not data or ("query" not in data and "queries" not in data):
+            return jsonify({"error": "query or queries is required"}), 400
+
+        batched = "queries" in data
+        queries = data["queries"] if batched else [data["query"]]
+        if (
+            not isinstance(queries, list)
+            or not queries
+            or not all(isinstance(query, str) for query in queries)
+        ):
+            return jsonify({"error": "queries must be a non-empty list of strings"}), 400
 
-        query = data["query"]
         video_id = data.get("video_id")
         top_k = data.get("top_k", 10)
+        empty = [[] for _ in queries] if batched else []
 
-        # Get model and index
-        embedding_model = get_model()
+        # Get index
         index = get_faiss_index()
 
         if index.ntotal == 0:
-            return jsonify({"results": []})
+            return jsonify({"results": empty})
+
+        # Generate query embeddings
+        query_vectors = embed_queries(queries)
+
+        # Filter by video inside FAISS if specified
+        if video_id:
+            positions = metadata.video_positions.get(int(video_id))
+            if positions is None:
+                return jsonify({"results": empty})
+            distances, indices = search_positions(
+                index, query_vectors, min(top_k, len(positions)), positions
+            )
+        else:
+            distances, indices = index.search(query_vectors, min(top_k, index.ntotal))
 
-        # Generate query embedding
-        query_embedding = embedding_model.encode([query], show_progress_bar=False)
-        query_vector = np.array(query_embedding, dtype=np.float32)
+        results = [format_results(idxs, dists) for idxs, dists in zip(indices, distances)]
 
-        # Search - get more results if filtering by video
-        search_k = (
-            min(top_k * 10, index.ntotal) if video_id else min(top_k, index.ntotal)
-        )
+        return jsonify({"results": results if batched else results[0]})
+
+    except Exception as e:
+        logger.exception("Search failed")
+        return jsonify({"error": str(e)}), 500
 
-        distances, indices = index.search(query_vector, search_k)
 
-        # Process results
-        results = []
-        for dist, idx in zip(distances[0], indices[0]):
-            if idx == -1:
-                continue
+@app.route("/reserve", methods=["POST"])
+def reserve():
+    """
+    Preallocate index storage ahead of a large ingest
+
+    Request JSON:
+    {
+        "vectors": 500000  // expected number of vectors to be added
+    }
 
-            meta = metadata.get(str(idx))
-            if not meta:
-                continue
+    Only this worker's index is reserved. A memory-mapped index is loaded
+    into memory first and stays there, instead of being mapped again once
+    writes go idle, until it holds the reserved number of vectors. Reloading a
+    newer index saved by another worker drops the reservation.
+    """
+    global reserved_capacity
 
-            # Filter by video if specified
-            if video_id and meta.get("video_id") != video_id:
-                continue
+    try:
+        data = request.get_json(silent=True) or {}
+        count = int(data.get("vectors", FAISS_RESERVE))
 
-            # Convert L2 distance to similarity score (0-1 range)
-            # Lower distance = higher similarity
-            similarity = 1 / (1 + dist)
+        if count < 0:
+            return jsonify({"error": "vectors must not be negative"}), 400
 
-            results.append(
-                {
-                    "transcript_id": meta["transcript_id"],
-                    "video_id": meta.get("video_id"),
-                    "similarity": round(float(similarity), 4),
-                }
-            )
+        with index_lock:
+            index = get_writable_faiss_index()
+            capacity = index.ntotal + count
+            if not reserve_faiss_index(index, capacity):
+                return jsonify({"error": "index type does not support reserving storage"}), 400
+            reserved_capacity = max(reserved_capacity, capacity)
 
-            if len(results) >= top_k:
-                break
+        logger.info("Reserved FAISS storage for %d vectors", capacity)
 
-        return jsonify({"results": results})
+        return jsonify(
+            {"message": f"Reserved storage for {capacity} vectors", "capacity": capacity}
+        )
 
     except Exception as e:
-        print(f"Search error: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Reserve failed")
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/clear", methods=["POST"])
 def clear_index():
     """Clear the FAISS index (for development/testing)"""
-    global faiss_index, metadata
+    global faiss_index, metadata, pending_vectors, index_mapped, reserved_capacity
 
     try:
-        embedding_dim = 384
-        faiss_index = faiss.IndexFlatL2(embedding_dim)
-        metadata = {}
-        save_faiss_index()
+        with index_lock, file_lock(FAISS_INDEX_PATH + ".lock"):
+            faiss_index = create_faiss_index()
+            index_mapped = False
+            reserved_capacity = 0
+            metadata = MetaTable.create(METADATA_PATH)
+            pending_vectors = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+            save_faiss_index()
 
         return jsonify({"message": "Index cleared"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+# Initialize FAISS index at import, so gunicorn --preload loads it once and
+# shares it with the forked workers. The model is loaded in each worker:
+# ONNX Runtime and OpenMP thread pools do not survive a fork, so loading (or
+# rebuilding an outdated index) runs single-threaded here, under the file lock
+# in case several workers import the app without --preload.
+logger.info("Initializing FAISS index...")
+faiss.omp_set_num_threads(1)
+with file_lock(FAISS_INDEX_PATH + ".lock"):
+    get_faiss_index()
+
+
 if __name__ == "__main__":
     # Pre-load model
-    print("Pre-loading embedding model...")
+    logger.info("Pre-loading embedding model...")
     get_model()
 
-    # Initialize FAISS index
-    print("Initializing FAISS index...")
-    get_faiss_index()
-
     # Start Flask server
     port = int(os.environ.get("EMBEDDING_PORT", 5001))
-    print(f"Starting Embedding service on port {port}")
+    logger.info("Starting Embedding service on port %d", port)
     app.run(host="0.0.0.0", port=port, debug=False)
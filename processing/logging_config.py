@@ -0,0 +1,47 @@
+"""
+Logging setup for the processing services
+Records are handed to a queue; a background listener thread writes them to stderr
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s"
+
+log_queue = queue.SimpleQueue()
+listener = None
+
+
+def start_listener():
+    """Start the thread that writes queued records (again after a fork)"""
+    global listener
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+
+
+def stop_listener():
+    """Flush queued records on exit"""
+    if listener is not None:
+        listener.stop()
+
+
+def get_logger(name):
+    """Get a logger whose output is written by the background listener"""
+    if listener is None:
+        start_listener()
+        # Threads do not survive fork(), so gunicorn workers need their own listener
+        os.register_at_fork(after_in_child=start_listener)
+        atexit.register(stop_listener)
+
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        logger.setLevel(LOG_LEVEL)
+        logger.propagate = False
+    return logger
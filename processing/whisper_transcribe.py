@@ -1,37 +1,114 @@
 """
 Whisper Transcription Service
-Flask API for transcribing audio files using OpenAI Whisper
+Flask API for transcribing audio files using Whisper (faster-whisper / CTranslate2)
 """
 
 import os
-import whisper
+import threading
+import ctranslate2
+from faster_whisper import WhisperModel
 from flask import Flask, request, jsonify
-import traceback
+from logging_config import get_logger
 
 app = Flask(__name__)
+logger = get_logger('whisper')
 
 # Configuration
 WHISPER_MODEL = os.environ.get('WHISPER_MODEL', 'medium')
 MODEL_DIR = os.environ.get('MODEL_DIR', '/app/models')
+# Skip silent regions with Silero VAD before decoding (timestamps stay on the original timeline)
+VAD_FILTER = os.environ.get('WHISPER_VAD_FILTER', 'true').lower() == 'true'
+VAD_MIN_SILENCE_MS = int(os.environ.get('WHISPER_VAD_MIN_SILENCE_MS', 500))
+# 'auto' uses CUDA when a GPU is visible; 'cuda' or 'cpu' force a device
+WHISPER_DEVICE = os.environ.get('WHISPER_DEVICE', 'auto')
+# Defaults to float16 on CUDA (tensor cores) and int8 on CPU
+WHISPER_COMPUTE_TYPE = os.environ.get('WHISPER_COMPUTE_TYPE')
+# CPU threads per transcription; a single worker avoids oversubscribing cores
+WHISPER_THREADS = int(os.environ.get('WHISPER_THREADS', os.cpu_count() or 1))
 
 # Load model on startup
-print(f"Loading Whisper model: {WHISPER_MODEL}")
+logger.info("Loading Whisper model: %s", WHISPER_MODEL)
 model = None
+model_device = None
+cpu_model = None  # CPU fallback for requests that run out of GPU memory
+model_lock = threading.Lock()  # Request threads must not load the model twice
+
+def load_model(device, compute_type=None):
+    """Load the Whisper model on the given device"""
+    compute_type = compute_type or ('float16' if device == 'cuda' else 'int8')
+    loaded = WhisperModel(
+        WHISPER_MODEL,
+        device=device,
+        compute_type=compute_type,
+        cpu_threads=WHISPER_THREADS,
+        num_workers=1,
+        download_root=MODEL_DIR
+    )
+    logger.info("Whisper model '%s' loaded successfully (%s, %s)", WHISPER_MODEL, device, compute_type)
+    return loaded
+
+def get_cpu_model():
+    """Get a CPU model for retrying a request; the CUDA model stays loaded"""
+    global cpu_model
+    with model_lock:
+        if model_device == 'cpu':
+            return model
+        if cpu_model is None:
+            cpu_model = load_model('cpu', 'int8')
+    return cpu_model
 
 def get_model():
-    global model
-    if model is None:
-        model = whisper.load_model(WHISPER_MODEL, download_root=MODEL_DIR)
-        print(f"Whisper model '{WHISPER_MODEL}' loaded successfully")
+    global model, model_device
+    with model_lock:
+        if model is None:
+            device = WHISPER_DEVICE
+            if device == 'auto':
+                device = 'cuda' if ctranslate2.get_cuda_device_count() > 0 else 'cpu'
+
+            try:
+                model = load_model(device, WHISPER_COMPUTE_TYPE)
+                model_device = device
+            except (RuntimeError, ValueError) as e:
+                if device != 'cuda':
+                    raise
+                logger.warning("Loading Whisper on CUDA failed (%s), falling back to CPU", e)
+                model = load_model('cpu', 'int8')
+                model_device = 'cpu'
     return model
 
+def run_transcription(whisper_model, audio_path, data):
+    """Transcribe an audio file and return (segments, info)"""
+    # Transcribe with word-level timestamps (segments are decoded lazily)
+    segments_iter, info = whisper_model.transcribe(
+        audio_path,
+        language=data.get('language', None),  # Auto-detect if not specified
+        word_timestamps=True,
+        beam_size=5,
+        vad_filter=data.get('vad_filter', VAD_FILTER),
+        vad_parameters={'min_silence_duration_ms': VAD_MIN_SILENCE_MS}
+    )
+    
+    # Format segments
+    segments = []
+    for seg in segments_iter:
+        segment_data = {
+            'start': round(seg.start, 2),
+            'end': round(seg.end, 2),
+            'text': seg.text.strip(),
+            'confidence': round(seg.avg_logprob * -1, 3) if seg.avg_logprob is not None else None
+        }
+        segments.append(segment_data)
+    
+    return segments, info
+
 @app.route('/health', methods=['GET'])
 def health():
     """Health check endpoint"""
     return jsonify({
         'status': 'ok',
         'model': WHISPER_MODEL,
-        'model_loaded': model is not None
+        'model_loaded': model is not None,
+        'device': model_device
     })
 
 @app.route('/transcribe', methods=['POST'])
@@ -41,7 +118,8 @@ def transcribe():
     
     Request JSON:
     {
-        "audio_path": "/path/to/audio.wav"
+        "audio_path": "/path/to/audio.wav",
+        "vad_filter": true  // optional, defaults to WHISPER_VAD_FILTER
     }
     
     Response JSON:
@@ -69,41 +147,30 @@ def transcribe():
         if not os.path.exists(audio_path):
             return jsonify({'error': f'Audio file not found: {audio_path}'}), 404
         
-        print(f"Transcribing: {audio_path}")
+        logger.info("Transcribing: %s", audio_path)
         
         # Get model
         whisper_model = get_model()
         
-        # Transcribe with word-level timestamps
-        result = whisper_model.transcribe(
-            audio_path,
-            language=data.get('language', None),  # Auto-detect if not specified
-            verbose=False,
-            word_timestamps=True
-        )
-        
-        # Format segments
-        segments = []
-        for seg in result['segments']:
-            segment_data = {
-                'start': round(seg['start'], 2),
-                'end': round(seg['end'], 2),
-                'text': seg['text'].strip(),
-                'confidence': round(seg.get('avg_logprob', 0) * -1, 3) if 'avg_logprob' in seg else None
-            }
-            segments.append(segment_data)
+        try:
+            segments, info = run_transcription(whisper_model, audio_path, data)
+        except RuntimeError as e:
+            # Retry this request on CPU when the GPU runs out of memory
+            if model_device != 'cuda' or 'out of memory' not in str(e).lower():
+                raise
+            logger.warning("CUDA out of memory, retrying transcription on CPU")
+            segments, info = run_transcription(get_cpu_model(), audio_path, data)
         
-        print(f"Transcription complete: {len(segments)} segments")
+        logger.info("Transcription complete: %d segments", len(segments))
         
         return jsonify({
             'segments': segments,
-            'language': result.get('language', 'unknown'),
-            'duration': segments[-1]['end'] if segments else 0
+            'language': info.language or 'unknown',
+            'duration': round(info.duration, 2)
         })
         
     except Exception as e:
-        print(f"Transcription error: {str(e)}")
-        traceback.print_exc()
+        logger.exception("Transcription failed")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/models', methods=['GET'])
@@ -121,12 +188,13 @@ def list_models():
         }
     })
 
+# Load the model at import: gunicorn (without --preload) imports the app
+# once per worker, before any request thread runs
+logger.info("Pre-loading Whisper model...")
+get_model()
+
 if __name__ == '__main__':
-    # Pre-load model
-    print("Pre-loading Whisper model...")
-    get_model()
-    
     # Start Flask server
     port = int(os.environ.get('WHISPER_PORT', 5000))
-    print(f"Starting Whisper service on port {port}")
+    logger.info("Starting Whisper service on port %d", port)
     app.run(host='0.0.0.0', port=port, debug=False)